@@ -1,29 +1,58 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import mmap
 import os
+import pickle
 import re
 import subprocess
 import sys
 import tempfile
 
 
+# data/mask are kept as hex strings and only converted for events whose
+# pc and addr already match an expectation.
+MemW = collections.namedtuple("MemW", "pc addr data_hex mask_hex")
+Reg = collections.namedtuple("Reg", "pc rd val")
+
+# 00000100 D g_data0
+_NM_RE = re.compile(rb"^([0-9a-fA-F]+)\s+\S\s+(\S+)")
+# [MEMW] pc=0x44 addr=0xd4 data=0x12345678 mask=0xf  -> groups 1..4
+_MEMW_PAT = rb"\[MEMW\][ \t]+pc=0x([0-9a-fA-F]+)[ \t]+addr=0x([0-9a-fA-F]+)[ \t]+data=0x([0-9a-fA-F]+)[ \t]+mask=0x([0-9a-fA-F]+)"
+# [REG] pc=0x30 x5 <= 0x12345678                     -> groups 5..7
+_REG_PAT = rb"\[REG\][ \t]+pc=0x([0-9a-fA-F]+)[ \t]+x([0-9]+)[ \t]+<=[ \t]+0x([0-9a-fA-F]+)"
+# One pass classifies and captures both event kinds
+_EVENT_RE = re.compile(rb"^[ \t]*(?:" + _MEMW_PAT + rb"|" + _REG_PAT + rb")", re.M)
+_LABEL_RE = re.compile(rb"^\s*[0-9a-fA-F]+\s+<([^>]+)>:")
+# Captures pc, mnemonic and the first operand only (instructions without
+# operands do not match)
+_INSN_RE = re.compile(rb"^\s*([0-9a-fA-F]+):\s+[0-9a-fA-F ]+\t([a-z0-9\.]+)\s+([^,\s]+)")
+# Bump when the layout of the index_objdump result changes
+_OBJDUMP_CACHE_VERSION = 1
+_WRITE_MNEMS = frozenset({
+    "addi","add","sub","lui","ori","xori","andi",
+    "slli","srli","srai","auipc","and","or","xor",
+    "sll","srl","sra","slti","sltiu","slt","sltu",
+    "jal","jalr","csrrw","csrrs","csrrc","csrrwi","csrrsi","csrrci","li",
+    "c.li","c.mv","c.add","c.addi","c.addi4spn","c.addi16sp","c.lui",
+    "c.slli","c.srli","c.srai","c.andi","c.sub","c.and","c.or","c.xor"
+})
+_STORES_BRANCHES = frozenset({"sb","sh","sw","beq","bne","blt","bge","bltu","bgeu"})
+_ABI_MAP = {5:"t0",6:"t1",7:"t2",28:"t3"}
+
+
 def parse_nm(nm_path):
     syms = {}
-    with open(nm_path, "r") as f:
+    with open(nm_path, "rb") as f:
         for line in f:
-            parts = line.strip().split()
-            if len(parts) >= 3:
-                addr_hex, typ, name = parts[0], parts[1], parts[2]
-                try:
-                    addr = int(addr_hex, 16)
-                    syms[name] = addr
-                except ValueError:
-                    pass
+            m = _NM_RE.match(line)
+            if m:
+                syms[m.group(2).decode("ascii")] = int(m.group(1), 16)
     return syms
 
 
-def run_runner(runner, elf, tohost, max_cycles, log_flags, log_file):
-    cmd = [
+def runner_cmd(runner, elf, tohost, max_cycles, log_flags):
+    return [
         runner,
         elf,
         "--tohost",
@@ -32,94 +61,145 @@ def run_runner(runner, elf, tohost, max_cycles, log_flags, log_file):
         str(max_cycles),
         "--log",
         log_flags,
-        "--log-file",
-        log_file,
     ]
+
+
+def run_runner(runner, elf, tohost, max_cycles, log_flags, log_file, quiet=False):
+    # The trace goes to log_file; runner messages go straight to our stdout
+    # (or nowhere when quiet) rather than being captured.
+    cmd = runner_cmd(runner, elf, tohost, max_cycles, log_flags) + ["--log-file", log_file]
     print("RUN:", " ".join(cmd))
-    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    print(cp.stdout)
+    sys.stdout.flush()
+    cp = subprocess.run(cmd, stdout=subprocess.DEVNULL if quiet else None, stderr=subprocess.STDOUT)
     return cp.returncode
 
 
-def parse_memw(log_path):
-    # [MEMW] pc=0x44 addr=0xd4 data=0x12345678 mask=0xf
+def stream_runner(runner, elf, tohost, max_cycles, log_flags, quiet=False):
+    # Without --log-file the runner writes its trace to stdout; parse it as
+    # it arrives instead of round-tripping through a file.
+    cmd = runner_cmd(runner, elf, tohost, max_cycles, log_flags)
+    print("RUN:", " ".join(cmd))
+    sys.stdout.flush()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1 << 20) as proc:
+        memw, regs = parse_log_stream(proc.stdout, echo=not quiet)
+    return proc.returncode, memw, regs
+
+
+def _add_event(m, memw, regs):
+    # Dispatch an _EVENT_RE match on which alternative captured
+    if m.group(1) is not None:
+        pc = int(m.group(1), 16)
+        addr = int(m.group(2), 16)
+        memw.append(MemW(pc, addr, m.group(3), m.group(4)))
+    else:
+        pc = int(m.group(5), 16)
+        rd = int(m.group(6), 10)
+        val = int(m.group(7), 16)
+        regs.append(Reg(pc, rd, val))
+
+
+def parse_log(log_path):
+    # Scan the mapped runner log for [MEMW] and [REG] lines
     memw = []
-    pat = re.compile(
-        r"^\[MEMW\]\s+pc=0x([0-9a-fA-F]+)\s+addr=0x([0-9a-fA-F]+)\s+data=0x([0-9a-fA-F]+)\s+mask=0x([0-9a-fA-F]+)"
-    )
-    with open(log_path, "r") as f:
-        for line in f:
-            m = pat.match(line.strip())
-            if m:
-                pc = int(m.group(1), 16)
-                addr = int(m.group(2), 16)
-                data = int(m.group(3), 16)
-                mask = int(m.group(4), 16)
-                memw.append({"pc": pc, "addr": addr, "data": data, "mask": mask})
-    return memw
+    regs = []
+    if os.path.getsize(log_path) == 0:
+        return memw, regs
+    with open(log_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for m in _EVENT_RE.finditer(mm):
+            _add_event(m, memw, regs)
+    return memw, regs
 
 
-def parse_reg(log_path):
-    # [REG] pc=0x30 x5 <= 0x12345678
+def parse_log_stream(stream, echo=True):
+    # Same as parse_log, but over a binary line stream (the runner's stdout).
+    # Lines that are not trace events are runner messages and are echoed.
+    memw = []
     regs = []
-    pat = re.compile(
-        r"^\[REG\]\s+pc=0x([0-9a-fA-F]+)\s+x([0-9]+)\s+<=\s+0x([0-9a-fA-F]+)"
-    )
-    with open(log_path, "r") as f:
+    for line in stream:
+        m = _EVENT_RE.match(line)
+        if m:
+            _add_event(m, memw, regs)
+        elif echo and not line.startswith(b"["):
+            sys.stdout.write(line.decode("utf-8", "replace"))
+    return memw, regs
+
+
+def index_objdump(objdump_path, labels=None):
+    # Single pass over the disassembly: map each label to the instructions
+    # of its block as (pc, mnem, op0). Only the first block of a label that
+    # appears more than once is kept; if `labels` is given, blocks of other
+    # labels are skipped rather than held in memory.
+    index = {}
+    if not os.path.exists(objdump_path):
+        return index
+    block = None
+    with open(objdump_path, "rb") as f:
         for line in f:
-            m = pat.match(line.strip())
+            m = _LABEL_RE.match(line)
+            if m:
+                label = m.group(1).decode("ascii")
+                if label in index or (labels is not None and label not in labels):
+                    block = None
+                else:
+                    block = index[label] = []
+                continue
+            if block is None:
+                continue
+            m = _INSN_RE.match(line)
             if m:
                 pc = int(m.group(1), 16)
-                rd = int(m.group(2), 10)
-                val = int(m.group(3), 16)
-                regs.append({"pc": pc, "rd": rd, "val": val})
-    return regs
+                block.append((pc, m.group(2).decode("ascii"), m.group(3).decode("ascii")))
+    return index
+
+
+def load_objdump_index(objdump_path, labels=None):
+    # index_objdump, cached next to the objdump as <objdump>.cache.pkl and
+    # reused while the objdump's mtime/size (and the label filter) match.
+    if not os.path.exists(objdump_path):
+        return {}
+    st = os.stat(objdump_path)
+    key = (_OBJDUMP_CACHE_VERSION, st.st_mtime_ns, st.st_size,
+           None if labels is None else sorted(labels))
+    cache_path = objdump_path + ".cache.pkl"
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, index = pickle.load(f)
+        if cached_key == key:
+            return index
+    except Exception:
+        # any unreadable or damaged cache just means "rebuild"
+        pass
+    index = index_objdump(objdump_path, labels)
+    # write to a temp file and rename so concurrent runs never see a
+    # partially written cache
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(cache_path) or ".",
+                                         prefix=os.path.basename(cache_path) + ".",
+                                         suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            pickle.dump((key, index), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return index
 
-def parse_objdump_for_final_reg_pc(objdump_path, label, rd_num):
+
+def parse_objdump_for_final_reg_pc(index, label, rd_num):
     # Scan the disassembly block of `label:`; return the PC of the last
     # instruction that writes to x<rd_num>. We consider common register-writing
     # mnemonics and exclude stores/branches.
-    if not os.path.exists(objdump_path):
-        return None
-    with open(objdump_path, "r") as f:
-        lines = f.readlines()
-    label_re = re.compile(r"^\s*([0-9a-fA-F]+)\s+<{}>:".format(re.escape(label)))
-    next_label_re = re.compile(r"^\s*[0-9a-fA-F]+\s+<[^>]+>:")
-    insn_re = re.compile(r"^\s*([0-9a-fA-F]+):\s+[0-9a-fA-F ]+\s+\t([a-z0-9\.]+)\s+(.*)$")
-    write_mnems = {
-        "addi","add","sub","lui","ori","xori","andi",
-        "slli","srli","srai","auipc","and","or","xor",
-        "sll","srl","sra","slti","sltiu","slt","sltu",
-        "jal","jalr","csrrw","csrrs","csrrc","csrrwi","csrrsi","csrrci","li"
-    }
-    start = -1
-    for i, line in enumerate(lines):
-        if label_re.match(line):
-            start = i + 1
-            break
-    if start < 0:
+    if label not in index:
         return None
     last_pc = None
-    i = start
-    while i < len(lines):
-        if next_label_re.match(lines[i]):
-            break
-        m = insn_re.match(lines[i])
-        if m:
-            pc = int(m.group(1), 16)
-            mnem = m.group(2)
-            ops_str = m.group(3)
-            # first operand should be x<rd_num>
-            ops = [o.strip() for o in ops_str.split(",") if o.strip()]
-            if ops:
-                op0 = ops[0]
-                # accept both numeric and ABI names for the rd
-                abi_map = {5:"t0",6:"t1",7:"t2",28:"t3"}
-                ok_rd = (op0 == f"x{rd_num}") or (abi_map.get(rd_num) == op0)
-                if ok_rd and (mnem not in ("sb","sh","sw","beq","bne","blt","bge","bltu","bgeu")):
-                    if mnem in write_mnems or mnem.startswith("c."):
-                        last_pc = pc
-        i += 1
+    for pc, mnem, op0 in index[label]:
+        # first operand should be x<rd_num>
+        # accept both numeric and ABI names for the rd
+        ok_rd = (op0 == f"x{rd_num}") or (_ABI_MAP.get(rd_num) == op0)
+        if ok_rd and (mnem not in _STORES_BRANCHES):
+            if mnem in _WRITE_MNEMS:
+                last_pc = pc
     return last_pc
 
 
@@ -129,6 +209,9 @@ def main():
     parser.add_argument("--max-cycles", type=int, default=5000)
     parser.add_argument("--runner", default=None, help="Path to kronos_rv32 (optional)")
     parser.add_argument("--build-skiptrap", action="store_true")
+    parser.add_argument("--save-log", action="store_true",
+                        help="Have the runner write its log to a temp file (kept on failure) instead of streaming stdout")
+    parser.add_argument("--quiet", action="store_true", help="Do not show the runner's own output")
     args = parser.parse_args()
 
     root = args.root
@@ -175,32 +258,41 @@ def main():
         {"pc": pcs["L_SW_TOHOST"], "addr": tohost, "data": 0x1, "mask": 0xF},            # exit
     ]
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, prefix="skiptrap_log_", suffix=".txt")
-    tmp.close()
-
-    rc = run_runner(runner, elf, tohost, args.max_cycles, "reg,mem,trap", tmp.name)
+    if args.save_log:
+        tmp = tempfile.NamedTemporaryFile(delete=False, prefix="skiptrap_log_", suffix=".txt")
+        tmp.close()
+        rc = run_runner(runner, elf, tohost, args.max_cycles, "reg,mem,trap", tmp.name, args.quiet)
+    else:
+        tmp = None
+        rc, got, got_reg = stream_runner(runner, elf, tohost, args.max_cycles, "reg,mem,trap", args.quiet)
     if rc != 0:
         print("Runner exited with non-zero:", rc, file=sys.stderr)
         return rc
 
-    got = parse_memw(tmp.name)
-    got_reg = parse_reg(tmp.name)
+    if tmp is not None:
+        got, got_reg = parse_log(tmp.name)
+    by_pc = {}
+    by_addr = {}
+    for i, w in enumerate(got):
+        by_pc.setdefault(w.pc, []).append((i, w))
+        by_addr.setdefault(w.addr, []).append(w)
     # 严格匹配：pc+addr+data+mask 一一对应
     errors = []
-    positions = {}
-    for idx, e in enumerate(EXP):
+    positions = []
+    for e in EXP:
         if e["pc"] is None:
             errors.append(f"Symbol PC not found for an expected event: {e}")
             continue
         # 允许因流水对齐产生的轻微偏移：{pc, pc+2, pc+4, pc+6, pc+8}
         ok = None
         for off in (0, 2, 4, 6, 8):
-            cand = next((i for i, w in enumerate(got)
-                         if w["pc"] == e["pc"] + off and w["addr"] == e["addr"]
-                         and w["mask"] == e["mask"] and w["data"] == e["data"]), None)
-            if cand is not None:
-                positions[idx] = cand
-                ok = True
+            for i, w in by_pc.get(e["pc"] + off, ()):
+                if (w.addr == e["addr"] and int(w.mask_hex, 16) == e["mask"]
+                        and int(w.data_hex, 16) == e["data"]):
+                    positions.append(i)
+                    ok = True
+                    break
+            if ok:
                 break
         if not ok:
             errors.append(
@@ -208,24 +300,28 @@ def main():
             )
     # 顺序约束：事件出现顺序应与程序顺序一致
     if not errors:
-        for i in range(len(EXP) - 1):
-            if positions[i] >= positions[i + 1]:
-                errors.append(f"Order mismatch between event {i} and {i+1}")
+        bad = next((i for i, (a, b) in enumerate(zip(positions, positions[1:])) if a >= b), None)
+        if bad is not None:
+            errors.append(f"Order mismatch between event {bad} and {bad+1}")
 
     # Ensure对齐错误 sw g_data0+2 未实际写入（地址对齐到 g_data0，所以检查该地址总写次数仅一次）
-    writes_g0 = [w for w in got if w["addr"] == g_data0]
-    if len(writes_g0) != 1 or not (writes_g0[0]["data"] == 0x12345678 and writes_g0[0]["mask"] == 0xF):
+    writes_g0 = by_addr.get(g_data0, [])
+    if len(writes_g0) != 1 or not (int(writes_g0[0].data_hex, 16) == 0x12345678
+                                    and int(writes_g0[0].mask_hex, 16) == 0xF):
         errors.append(f"Unexpected extra write(s) to g_data0 (found {len(writes_g0)})")
 
     # 确认：在 L_MISALIGNED_SW 的 PC 上不应出现任何 [MEMW]
-    if pcs["L_MISALIGNED_SW"] is not None and any(w["pc"] == pcs["L_MISALIGNED_SW"] for w in got):
+    if pcs["L_MISALIGNED_SW"] is not None and pcs["L_MISALIGNED_SW"] in by_pc:
         errors.append("Unexpected MEMW at misaligned SW PC")
 
     if errors:
         print("FAIL:")
         for e in errors:
             print(" -", e)
-        print("\nLog saved at:", tmp.name)
+        if tmp is not None:
+            print("\nLog saved at:", tmp.name)
+        else:
+            print("\nhint: rerun with --save-log to keep the runner trace")
         return 1
 
     # Register strict checks using objdump-derived exact PCs
@@ -236,30 +332,36 @@ def main():
         {"label": "L_LI_T3", "rd": 28, "val": 0x0},         # t3
         {"label": "L_LI_T0_1", "rd": 5, "val": 0x1},        # t0 before tohost
     ]
+    objdump_index = load_objdump_index(objdump_path, {e["label"] for e in REG_EXP})
     final_pc_map = {}
     for e in REG_EXP:
-        pc = parse_objdump_for_final_reg_pc(objdump_path, e["label"], e["rd"])
+        pc = parse_objdump_for_final_reg_pc(objdump_index, e["label"], e["rd"])
         if pc is None:
             errors.append(f"Objdump PC not found for label {e['label']}")
         else:
             final_pc_map[e["label"]] = pc
 
+    reg_set = set(got_reg)
     for e in REG_EXP:
         if e["label"] not in final_pc_map:
             continue
         pc_req = final_pc_map[e["label"]]
-        if not any((w["pc"] == pc_req and w["rd"] == e["rd"] and w["val"] == e["val"]) for w in got_reg):
+        if Reg(pc_req, e["rd"], e["val"]) not in reg_set:
             errors.append(f"Missing REG at exact pc=0x{pc_req:x} x{e['rd']} <= 0x{e['val']:x} (label {e['label']})")
 
     if errors:
         print("FAIL:")
         for e in errors:
             print(" -", e)
-        print("\nLog saved at:", tmp.name)
+        if tmp is not None:
+            print("\nLog saved at:", tmp.name)
+        else:
+            print("\nhint: rerun with --save-log to keep the runner trace")
         return 1
 
     print("PASS: strict REG+MEMW checks passed; misaligned store suppressed.")
-    os.unlink(tmp.name)
+    if tmp is not None:
+        os.unlink(tmp.name)
     return 0
 
 